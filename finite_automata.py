@@ -2,8 +2,9 @@
 This module was created to simplify work with finite automata
 
 """
+import io
 import re
-import itertools
+from collections import defaultdict, deque
 
 import exit_codes
 
@@ -41,9 +42,8 @@ _fsm_state_pattern = r'([a-zA-Z](?:[a-zA-Z_\d]*[a-zA-Z\d])?)'
 _fsm_sym_pattern = r'(\'{2,4}|\'[^\']\')'
 _fsm_component_pattern = r'\{(.*)\}'
 
-_fsm_rule_pattern = _fsm_state_pattern + r'\s*' + _fsm_sym_pattern \
-    + r'\s*->\s*' + _fsm_state_pattern
-
+# overall shape of the finite automata, components are not validated;
+# only used on the empty states error path, see _FAParser.parse
 _fsm_pattern = r'^\s*\(\s*' + _fsm_component_pattern \
     + r'\s*,\s*' + _fsm_component_pattern \
     + r'\s*,\s*' + _fsm_component_pattern \
@@ -51,24 +51,33 @@ _fsm_pattern = r'^\s*\(\s*' + _fsm_component_pattern \
     + r'\s*,\s*' + _fsm_component_pattern \
     + r'\s*\)\s*$'
 
-
-def _check_get_states(states_content):
-    if  re.match(r'^\s*$', states_content) is not None:
-        return set()
-
-    states_pattern = r'^(\s*' \
-        + _fsm_state_pattern + r'\s*,)*\s*' \
-        + _fsm_state_pattern + r'\s*$'
-
-    if re.match(states_pattern, states_content) is None:
-
-        raise FASyntaxException('bad states definition')
-
-    states = set()
-    for match in re.finditer(_fsm_state_pattern, states_content):
-        states.add(match.group(0))
-
-    return states
+_state_re = re.compile(_fsm_state_pattern)
+_sym_re = re.compile(_fsm_sym_pattern)
+_ws_re = re.compile(r'\s*')
+_fsm_re = re.compile(_fsm_pattern, re.S)
+
+
+def _strip_comments(content):
+    if '#' not in content:
+        return content
+
+    parts = []
+    start = pos = 0
+    while True:
+        pos = content.find('#', pos)
+        if pos < 0:
+            break
+        if pos > 0 and content[pos - 1] == '\'': # '#' input symbol
+            pos += 1
+            continue
+        parts.append(content[start:pos])
+        pos = content.find('\n', pos)
+        if pos < 0:
+            start = len(content)
+            break
+        start = pos
+    parts.append(content[start:])
+    return ''.join(parts)
 
 
 def _get_input_symbol(sym_content):
@@ -82,62 +91,116 @@ def _get_input_symbol(sym_content):
         return sym_content[1:-1]
 
 
-def _check_get_alphabet(alphabet_content):
-    alphabet_pattern = r'^(\s*' \
-        + _fsm_sym_pattern + r'\s*,)*\s*' \
-        + _fsm_sym_pattern + r'\s*$'
+class _FAParser:
+    """
+    Single pass parser of the finite automata definition
+
+    """
+    _format_errmsg = 'bad finite automata format'
 
-    if re.match(alphabet_pattern, alphabet_content, re.S) is None:
-        raise FASyntaxException('bad alphabet definition')
+    def __init__(self, content):
+        self.content = content
+        self.pos = 0
 
-    alphabet = set()
-    for match in re.finditer(_fsm_sym_pattern, alphabet_content, re.S):
-        input_symbol = _get_input_symbol(match.group(0))
-        if input_symbol is None:
-            raise FASyntaxException(
-                'bad symbol \"{}\"'.format(match.group(0)))
-        else:
-            alphabet.add(input_symbol)
+    def _skip_ws(self):
+        self.pos = _ws_re.match(self.content, self.pos).end()
 
-    return alphabet
+    def _accept(self, token):
+        self._skip_ws()
+        if self.content.startswith(token, self.pos):
+            self.pos += len(token)
+            return True
+        return False
 
+    def _expect(self, token, errmsg=_format_errmsg):
+        if not self._accept(token):
+            raise FASyntaxException(errmsg)
 
-def _check_get_rules(rules_content):
-    rules_pattern = r'^(\s*' \
-        + _fsm_rule_pattern + r'\s*,)*\s*' \
-        + _fsm_rule_pattern + r'\s*$'
+    def _match(self, regex, errmsg):
+        self._skip_ws()
+        match = regex.match(self.content, self.pos)
+        if match is None:
+            raise FASyntaxException(errmsg)
+        self.pos = match.end()
+        return match.group(0)
 
-    if re.match(rules_pattern, rules_content, re.S) is None:
-        raise FASyntaxException('bad rules definition')
+    def _state(self, errmsg):
+        return self._match(_state_re, errmsg)
 
-    rules = set()
-    for match in re.finditer(_fsm_rule_pattern, rules_content, re.S):
-        state = match.group(1)
-        input_symbol_content = match.group(2)
-        input_symbol = _get_input_symbol(input_symbol_content)
+    def _symbol(self, errmsg):
+        sym_content = self._match(_sym_re, errmsg)
+        input_symbol = _get_input_symbol(sym_content)
         if input_symbol is None:
             raise FASyntaxException(
-                'in rule \'{}\' bad symbol definition \"{}\"'
-                    .format(match.group(0)), input_symbol_content)
-        next_state = match.group(3)
-        rules.add(Rule(state, input_symbol, next_state))
-
-    return rules
+                'bad symbol \"{}\"'.format(sym_content))
+        return input_symbol
+
+    def _rule(self, errmsg):
+        state = self._state(errmsg)
+        input_symbol = self._symbol(errmsg)
+        self._expect('->', errmsg)
+        return Rule(state, input_symbol, self._state(errmsg))
+
+    def _component(self, parse_item, errmsg, can_be_empty=False):
+        self._expect('{')
+        items = set()
+        if can_be_empty and self._accept('}'):
+            return items
+        while True:
+            items.add(parse_item(errmsg))
+            if self._accept('}'):
+                return items
+            self._expect(',', errmsg)
+
+    def parse(self):
+        """Returns (states, alphabet, rules, start_state, final_states)"""
+        self._expect('(')
+        states = self._component(
+            self._state, 'bad states definition', can_be_empty=True)
+        if not states:
+            # compatibility shim, error path only: empty states are
+            # reported before errors inside the other components, but not
+            # before a broken overall format. The greedy whole-input
+            # pattern may backtrack, so it is never run on valid input.
+            match = _fsm_re.match(self.content)
+            if match is None:
+                raise FASyntaxException(_FAParser._format_errmsg)
+            elif match.group(1).strip():
+                raise FASyntaxException('bad states definition')
+            raise FASemanticException('states set should not be empty')
+        self._expect(',')
+        alphabet = self._component(self._symbol, 'bad alphabet definition')
+        self._expect(',')
+        rules = self._component(self._rule, 'bad rules definition')
+        self._expect(',')
+        start_state = self._state('bad start symbol definition')
+        self._expect(',')
+        final_states = self._component(
+            self._state, 'bad states definition', can_be_empty=True)
+        self._expect(')')
+        self._skip_ws()
+        if self.pos != len(self.content):
+            raise FASyntaxException(_FAParser._format_errmsg)
+
+        return states, alphabet, rules, start_state, final_states
 
 
 class Rule:
     """Represents the rule"""
+    __slots__ = ('state', 'input_symbol', 'next_state', '_hash')
+
     def __init__(self, state, input_symbol, next_state):
         self.input_symbol = input_symbol
         self.state = state
         self.next_state = next_state
+        self._hash = hash((input_symbol, state, next_state))
 
     def __eq__(self, other):
         return (self.input_symbol, self.state, self.next_state) \
             == (other.input_symbol, other.state, other.next_state)
 
     def __hash__(self):
-        return hash((self.input_symbol, self.state, self.next_state))
+        return self._hash
 
     def __str__(self):
         return '{} \'{}\' -> {}'.format(
@@ -146,156 +209,160 @@ class Rule:
 
 class FiniteAutomata:
     """Represents the finite automata"""
-    def __init__(self, fa_file_content):
-        fa_file_content = re.sub(
-            r'(?<!\')#.*$', '', fa_file_content, flags=re.MULTILINE)
-
-        match = re.match(_fsm_pattern, fa_file_content, re.S)
-        
-        if match is None:
-            raise FASyntaxException('bad finite automata format')
-
-        # print('states', match.group(1), sep=': ')
-        self.states = _check_get_states(match.group(1))
-        if not self.states:
-            raise FASemanticException('states set should not be empty')
+    __slots__ = ('states', 'alphabet', 'rules', 'start_state',
+                 'final_states')
 
-        self.alphabet = _check_get_alphabet(match.group(2))
-        self.rules = _check_get_rules(match.group(3))
-
-        if re.match(_fsm_state_pattern, match.group(4)) is None:
-            raise FASyntaxException('bad start symbol definition')
+    def __init__(self, fa_file_content):
+        fa_file_content = _strip_comments(fa_file_content)
 
-        self.start_state = match.group(4)
-        self.final_states = _check_get_states(match.group(5))
+        (self.states, self.alphabet, self.rules,
+            self.start_state, self.final_states) = \
+            _FAParser(fa_file_content).parse()
         self._check_semantic()
 
+    def _build_indexes(self):
+        """Returns (delta, by_state, inv, pred) indexes of the rules"""
+        # built on every call, the sets may change between calls
+        delta = {state: {} for state in self.states}
+        by_state = defaultdict(set)
+        inv = defaultdict(lambda: defaultdict(set))
+        pred = defaultdict(set)
+        for rule in self.rules:
+            delta[rule.state][rule.input_symbol] = rule.next_state
+            by_state[rule.state].add(rule)
+            inv[rule.input_symbol][rule.next_state].add(rule.state)
+            pred[rule.next_state].add(rule.state)
+        return delta, by_state, inv, pred
+
     def _check_semantic(self):
         if self.start_state not in self.states:
             raise FASemanticException(
                 'unrecognized start state \'{}\''.format(self.start_state)
             )
-        for rule in self.rules:
-            if rule.input_symbol not in self.alphabet:
-                raise FASemanticException(
-                    'unrecognized input symbol \'{}\' in rule \'{}\''
-                        .format(rule.input_symbol, rule)
-                )
-            elif rule.state not in self.states:
-                raise FASemanticException(
-                    'unrecognized state \'{}\' in rule \'{}\''
-                        .format(rule.state, rule)
-                )
-            elif rule.next_state not in self.states:
-                raise FASemanticException(
-                    'unrecognized next state \'{}\' in rule \'{}\''
-                        .format(rule.next_state, rule)
-                )
-            elif not self.final_states.issubset(self.states):
-                raise FASemanticException(
-                    'final states is not subset of states'
-                )
-            else:
-                pass
+        bad_symbols = \
+            {rule.input_symbol for rule in self.rules} - self.alphabet
+        if bad_symbols:
+            rule = next(rule for rule in self.rules
+                        if rule.input_symbol in bad_symbols)
+            raise FASemanticException(
+                'unrecognized input symbol \'{}\' in rule \'{}\''
+                    .format(rule.input_symbol, rule)
+            )
+        bad_states = {rule.state for rule in self.rules} - self.states
+        if bad_states:
+            rule = next(rule for rule in self.rules
+                        if rule.state in bad_states)
+            raise FASemanticException(
+                'unrecognized state \'{}\' in rule \'{}\''
+                    .format(rule.state, rule)
+            )
+        bad_states = {rule.next_state for rule in self.rules} - self.states
+        if bad_states:
+            rule = next(rule for rule in self.rules
+                        if rule.next_state in bad_states)
+            raise FASemanticException(
+                'unrecognized next state \'{}\' in rule \'{}\''
+                    .format(rule.next_state, rule)
+            )
+        if not self.final_states <= self.states:
+            raise FASemanticException(
+                'final states is not subset of states'
+            )
 
     def deterministic(self):
         """Returns True if the finite automata is well specified. Else returns False"""
-        for rule in self.rules:
-            if rule.input_symbol == '':
-                return False
-
-        state_symbol_list = \
-            [(rule.state, rule.input_symbol) for rule in self.rules]
-
-        if len(state_symbol_list) != len(set(state_symbol_list)):
+        delta, by_state, inv, _ = self._build_indexes()
+        if '' in inv:
             return False
 
-        return True
-    
-    def complete(self):
-        """Returns True if the finite automata is complete. Else returns False"""
-        for state in self.states:
-            state_input_symbols = set([rule.input_symbol \
-                    for rule in self.rules if rule.state == state])
-
-            if self.alphabet != state_input_symbols:
+        for state, rules in by_state.items():
+            if len(delta[state]) != len(rules):
                 return False
 
         return True
 
+    def complete(self):
+        """Returns True if the finite automata is complete. Else returns False"""
+        delta = self._build_indexes()[0]
+        return all(delta[state].keys() == self.alphabet
+                   for state in self.states)
+
     def all_states_are_accessible(self):
         """Returns True if all states are accessible. Else returns False"""
-        next_states = set([rule.next_state for rule in self.rules])
-        for state in self.states:
-            if state != self.start_state and not state in next_states:
-                return False
-
-        return True
+        by_state = self._build_indexes()[1]
+        accessible = {self.start_state}
+        queue = [self.start_state]
+        while queue:
+            state = queue.pop()
+            for rule in by_state.get(state, ()):
+                if rule.next_state not in accessible:
+                    accessible.add(rule.next_state)
+                    queue.append(rule.next_state)
+
+        return accessible == self.states
 
     def get_nonterminating_states(self):
         """Returns nonterminating_states in set form"""
+        pred = self._build_indexes()[3]
         term = set(self.final_states)
-        copy_rules = set(self.rules)
-        while True:
-            new_term = set()
-            rules_to_del = set()    
-            for rule in copy_rules:
-                if rule.state not in term and rule.next_state in term:
-                    new_term.add(rule.state)
-                    rules_to_del.add(rule)
-            copy_rules = copy_rules - rules_to_del
-            if len(new_term) == 0:
-                break
-            term = term | new_term
+        queue = deque(term)
+        while queue:
+            state = queue.popleft()
+            for prev_state in pred.get(state, ()):
+                if prev_state not in term:
+                    term.add(prev_state)
+                    queue.append(prev_state)
 
         return self.states - term
 
-    def __str__(self):
-        ret_str = '(\n{'
-        states_list = list(self.states)
-        states_list.sort()
-        for i, state in enumerate(states_list):
-            if i + 1 == len(states_list):
-                ret_str += state
-            else:
-                ret_str += '{}, '.format(state)
-        ret_str += '},\n{'
-        alphabet_list = list(self.alphabet)
-        alphabet_list.sort()
-        for i, input_symbol in enumerate(alphabet_list):
-            if input_symbol == '\'':
-                input_symbol = '\'\'' 
-
-            if i + 1 == len(alphabet_list):
-                ret_str += '\'{}\''.format(input_symbol)
-            else:
-                ret_str += '\'{}\', '.format(input_symbol)
-        ret_str += '},\n{\n'
-        rules_list = list(self.rules)
-        rules_list.sort(key=lambda rule: (rule.state, rule.input_symbol))
+    def write(self, file):
+        """Writes the finite automata in normalised form to the file"""
+        alphabet_list = ['\'\'' if input_symbol == '\'' else input_symbol
+                         for input_symbol in sorted(self.alphabet)]
+        file.write('(\n{')
+        file.write(', '.join(sorted(self.states)))
+        file.write('},\n{')
+        file.write(', '.join('\'{}\''.format(input_symbol)
+                             for input_symbol in alphabet_list))
+        file.write('},\n{\n')
+        rules_list = sorted(self.rules,
+                            key=lambda rule: (rule.state, rule.input_symbol))
         for i, rule in enumerate(rules_list):
             if i + 1 == len(rules_list):
-                ret_str += '{}\n'.format(rule)
-            else:
-                ret_str += '{},\n'.format(rule)
-        ret_str += '},\n'
-        ret_str += '{},\n'.format(self.start_state)
-        ret_str += '{'
-        final_states_list = list(self.final_states)
-        final_states_list.sort()
-        for i, final_state in enumerate(final_states_list):
-            if i + 1 == len(final_states_list):
-                ret_str += final_state
+                file.write('{}\n'.format(rule))
             else:
-                ret_str += '{}, '.format(final_state)
-        ret_str += '}\n)'
-        return ret_str
+                file.write('{},\n'.format(rule))
+        file.write('}},\n{},\n{{'.format(self.start_state))
+        file.write(', '.join(sorted(self.final_states)))
+        file.write('}\n)')
+
+    def __str__(self):
+        output = io.StringIO()
+        self.write(output)
+        return output.getvalue()
+
+
+_MAX_MASK_STATES = 64
+
+
+def _ids_to_mask(ids):
+    mask = 0
+    for i in ids:
+        mask |= 1 << i
+    return mask
+
 
+def _mask_to_ids(mask):
+    ids = []
+    while mask:
+        low_bit = mask & -mask
+        ids.append(low_bit.bit_length() - 1)
+        mask ^= low_bit
+    return ids
 
-def _gen_subsets(some_set):
-    for i in range(1, len(some_set)):
-        for sub in [set(x) for x in itertools.combinations(some_set, i)]:
-            yield (sub, some_set - sub)
+
+def _popcount(mask):
+    return bin(mask).count('1')
 
 
 def _connect_states(set_states):
@@ -312,6 +379,8 @@ def _connect_states(set_states):
 
 class WellSpecifiedFA(FiniteAutomata):
     """Represents well specified finite automata"""
+    __slots__ = ()
+
     def __init__(self, fa):
         self.states = fa.states
         self.alphabet = fa.alphabet
@@ -334,78 +403,74 @@ class WellSpecifiedFA(FiniteAutomata):
 
         raise FAException(err_msg, exit_codes.FA_NOT_WELL_SPEC) 
 
-    def _get_rules_with_states_sym(self, states, symbol):
-        ret_rules = set()
-        for rule in self.rules:
-            if rule.state in states and rule.input_symbol == symbol:
-                ret_rules.add(rule)
-        return ret_rules 
-
-    def _get_next_states_rule_set(self, rule_set):
-        next_states = set()
-        for rule in rule_set:
-            next_states.add(rule.next_state)
-        return next_states
-
     def minimize(self):
-        """Performs minimazing of the finite automata"""
-        Qm = set()
-        Qm.add(frozenset(self.final_states))
-        Qm.add(frozenset(self.states - self.final_states))
-        while True:
-            was_division = False
-            for symbol in self.alphabet:
-                updated_Qm = set(Qm)
-                for Q1 in Qm:
-                    if len(Q1) == 1:
+        """Performs minimazing of the finite automata (Hopcroft's algorithm)"""
+        inv = self._build_indexes()[2]
+        id_state = sorted(self.states)
+        state_id = {state: i for i, state in enumerate(id_state)}
+        # blocks of states are int bitmasks of state ids for small FA,
+        # mutable sets of state ids otherwise
+        if len(id_state) <= _MAX_MASK_STATES:
+            make_block, block_ids, block_len = \
+                _ids_to_mask, _mask_to_ids, _popcount
+        else:
+            make_block, block_ids, block_len = set, list, len
+
+        F = make_block(state_id[state] for state in self.final_states)
+        nonF = make_block(i for state, i in state_id.items()
+                          if state not in self.final_states)
+        blocks = [Q for Q in (F, nonF) if Q]
+        block_of = [0] * len(id_state)
+        for i, Q in enumerate(blocks):
+            for state in block_ids(Q):
+                block_of[state] = i
+        W = set()
+        if len(blocks) == 2:
+            W.add(0 if block_len(blocks[0]) <= block_len(blocks[1]) else 1)
+        while W:
+            A_ids = list(block_ids(blocks[W.pop()]))
+            for sym_inv in inv.values():
+                X_ids = [state_id[state] for next_state in A_ids
+                         for state in sym_inv.get(id_state[next_state], ())]
+                if not X_ids:
+                    continue
+                # only blocks containing a predecessor can be split
+                touched = defaultdict(list)
+                for state in X_ids:
+                    touched[block_of[state]].append(state)
+                for i, inter in touched.items():
+                    if len(inter) == block_len(blocks[i]):
                         continue
-                    rules_Q1_sym = \
-                        self._get_rules_with_states_sym(Q1, symbol)
-                    next_states = \
-                        self._get_next_states_rule_set(rules_Q1_sym)
-                    for q1_set, q2_set in _gen_subsets(next_states):
-                        if q1_set.issubset(Q1) and not q2_set & Q1:
-                            was_division = True
-                            X1 = set()
-                            for rule in rules_Q1_sym:
-                                if rule.next_state in q2_set:
-                                    X1.add(rule.state)
-                            X2 = set()
-                            for rule in rules_Q1_sym:
-                                if rule.next_state in q1_set:
-                                    X2.add(rule.state)
-
-                            updated_Qm.remove(X1 | X2)
-                            updated_Qm.add(frozenset(X1))
-                            updated_Qm.add(frozenset(X2))
-                            Qm = updated_Qm
-            if not was_division:
-                break
+                    # the predecessors move to a new block, so a split
+                    # costs O(|inter|); the block keeps its place in W
+                    # and the smaller half goes to W as well
+                    inter_block = make_block(inter)
+                    blocks[i] -= inter_block
+                    blocks.append(inter_block)
+                    j = len(blocks) - 1
+                    for state in inter:
+                        block_of[state] = j
+                    if i in W or len(inter) <= block_len(blocks[i]):
+                        W.add(j)
+                    else:
+                        W.add(i)
+        Qm = set(frozenset(id_state[i] for i in block_ids(Y))
+                 for Y in blocks)
+        name = {Q: _connect_states(Q) for Q in Qm}
+        block_name = {state: name[Q] for Q in Qm for state in Q}
         Rm = set()
-        for X in Qm:
-            for Y in Qm:
-                for x in X:
-                    for y in Y:
-                        for sym in self.alphabet:
-                            if Rule(x, sym, y) in self.rules:
-                                state = _connect_states(X)
-                                next_state = _connect_states(Y)
-                                Rm.add(Rule(state, sym, next_state))
-        for q in Qm:
-            if self.start_state in q:
-                self.start_state = _connect_states(q) # set start state
-                break
+        for rule in self.rules:
+            Rm.add(Rule(block_name[rule.state], rule.input_symbol,
+                        block_name[rule.next_state]))
+        self.start_state = block_name[self.start_state] # set start state
         Fm = set()
         for X in Qm:
-            if X & self.final_states:
-                Fm.add(X)
+            if not X.isdisjoint(self.final_states):
+                Fm.add(name[X])
 
         self.states.clear()
-        for Q in Qm:
-            self.states.add(_connect_states(Q))
+        self.states.update(name.values())
         self.rules.clear()
-        for R in Rm:
-            self.rules.add(R)
+        self.rules.update(Rm)
         self.final_states.clear()
-        for F in Fm:
-            self.final_states.add(_connect_states(F))
+        self.final_states.update(Fm)
@@ -29,6 +29,10 @@ from finite_automata import WellSpecifiedFA
 from finite_automata import FAException
 
 
+_opt_arg_re = re.compile(r'\w+=.+')
+_short_opt_re = re.compile(r'\-[^\-]')
+
+
 def print_stderr(*args, **kwargs):
     """Behave the same way as print() but by default prints on stderr"""
     print(*args, file=sys.stderr, **kwargs)
@@ -48,25 +52,25 @@ def get_options():
                 'invalid program argument \'' + args[0] + '\'')
        
         opts_list = [opt[0] for opt in options]
-        if len(opts_list) != len(set(opts_list)):
+        opts_set = set(opts_list)
+        if len(opts_list) != len(opts_set):
             raise getopt.GetoptError(
                 'cannot combine two or more same options')
 
-        if all(opt in opts_list for opt in ['--minimize', '-m']):
+        if opts_set.issuperset({'--minimize', '-m'}):
             raise getopt.GetoptError(
                     'cannot combine two or more same options')
 
-        if (all(opt in opts_list 
-            for opt in ['--find-non-finishing', '-f'])):
+        if opts_set.issuperset({'--find-non-finishing', '-f'}):
             raise getopt.GetoptError(
                     'cannot combine two or more same options')
 
-        if all(opt in opts_list for opt in ['--case-insensitive', '-i']):
+        if opts_set.issuperset({'--case-insensitive', '-i'}):
             raise getopt.GetoptError(
                     'cannot combine two or more same options')        
 
-        if (('-m' in opts_list or '--minimize' in opts_list) and
-            ('-f' in opts_list or '--find-non-finishing' in opts_list)):
+        if (('-m' in opts_set or '--minimize' in opts_set) and
+            ('-f' in opts_set or '--find-non-finishing' in opts_set)):
             raise getopt.GetoptError('cannot combine \'minimize\' and '
                 '\'find-non-finishing\' options')
 
@@ -74,7 +78,7 @@ def get_options():
             arg_input_output = (arg[2:].startswith('output') or
                 arg[2:].startswith('input'))
 
-            if arg_input_output and re.match(r'\w+=.+', arg[2:]) is None:
+            if arg_input_output and _opt_arg_re.match(arg[2:]) is None:
                 raise getopt.GetoptError(
                     'option \'' + arg + '\' requires argument')
     except getopt.GetoptError as opt_error:
@@ -84,7 +88,7 @@ def get_options():
 
     for opt in options:
         opt_str = opt[0][2:]
-        if re.match(r'^\-[^\-]', opt[0]):
+        if _short_opt_re.match(opt[0]):
             if opt[0] == '-m':
                 opt_str = 'minimize'
             elif opt[0] == '-f':
@@ -151,6 +155,7 @@ if __name__ == '__main__':
         sys.exit(exit_codes.SUCCESS)
 
     well_specified_fa.minimize()
-    print(well_specified_fa, file=output_file)
+    well_specified_fa.write(output_file)
+    output_file.write('\n')
     output_file.close()
     sys.exit(exit_codes.SUCCESS)